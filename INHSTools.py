@@ -5,6 +5,8 @@ import unittest
 import vtk, qt, ctk, slicer
 from slicer.ScriptedLoadableModule import *
 import logging
+import csv
+import shutil
 import numpy as np
 import string
 
@@ -38,6 +40,7 @@ This module imports an image database (csv file) from which individual fish imag
 <li>Once digitization is done, hit the <b>Export Landmarks</b> button to save the 
 landmarks into the correct output folder automatically. This will remove the fish from the table view</li>
 <li>You can now start the next unprocessed specimen</li>
+<li>Use <b>Check landmarks</b> under <b>Landmark QC</b> to flag exported landmark sets that are outliers within their Family or Genus. Results are listed in the <b>LandmarkOutliers</b> table.</li>
 </ol> 
 """
     self.parent.acknowledgementText = """
@@ -233,6 +236,30 @@ class INHSToolsWidget(ScriptedLoadableModuleWidget):
     self.exportSegmentationButton.enabled = False
     segmentTabLayout.addRow(self.exportSegmentationButton)
     
+    #
+    # Landmark QC area
+    #
+    landmarkQCButton = ctk.ctkCollapsibleButton()
+    landmarkQCButton.text = "Landmark QC"
+    landmarkQCButton.collapsed = True
+    self.layout.addWidget(landmarkQCButton)
+    landmarkQCLayout = qt.QFormLayout(landmarkQCButton)
+    
+    #
+    # Grouping column selector
+    #
+    self.groupColumnSelector = qt.QComboBox()
+    self.groupColumnSelector.addItems(["Family", "Genus"])
+    self.groupColumnSelector.setToolTip( "Metadata column used to group specimens for Procrustes alignment" )
+    landmarkQCLayout.addRow("Group by: ", self.groupColumnSelector)
+    
+    #
+    # Check Landmarks Button
+    #
+    self.checkLandmarksButton = qt.QPushButton("Check landmarks")
+    self.checkLandmarksButton.toolTip = "Flag exported landmark sets in the output path that are outliers within their group"
+    landmarkQCLayout.addRow(self.checkLandmarksButton)
+    
     # connections
     #self.applySpacingButton.connect('clicked(bool)', self.onApplySpacingButton)
     self.flipXButton.connect('clicked(bool)', self.onFlipX)
@@ -246,6 +273,7 @@ class INHSToolsWidget(ScriptedLoadableModuleWidget):
     self.launchMarkupsButton.connect('clicked(bool)', self.onLaunchMarkups)
     self.startSegmentationButton.connect('clicked(bool)', self.onStartSegmentation)
     self.exportSegmentationButton.connect('clicked(bool)', self.onExportSegmentation)
+    self.checkLandmarksButton.connect('clicked(bool)', self.onCheckLandmarks)
 
     
     # Add vertical spacer
@@ -276,6 +304,22 @@ class INHSToolsWidget(ScriptedLoadableModuleWidget):
     else:
       logging.debug("No valid segmentation to export.")
       
+  def onCheckLandmarks(self):
+    if not self.tableSelector.currentPath:
+      logging.debug("No metadata table selected.")
+      return
+    # keep the analysis between runs so only new exports are read
+    groupColumn = self.groupColumnSelector.currentText
+    if not hasattr(self, 'outlierAnalysis') or self.outlierAnalysis.groupColumn != groupColumn:
+      self.outlierAnalysis = ProcrustesOutlierAnalysis(groupColumn)
+    results = self.outlierAnalysis.run(self.outputDirSelector.currentPath, self.tableSelector.currentPath)
+    if hasattr(self, 'outlierTable'):
+      slicer.mrmlScene.RemoveNode(self.outlierTable)
+    logic = INHSToolsLogic()
+    self.outlierTable = logic.createOutlierTable(results)
+    flaggedCount = sum(result['flagged'] for result in results)
+    logging.info('%d of %d landmark files flagged for review' % (flaggedCount, len(results)))
+    
   def onLaunchMarkups(self):
     self.fiducialNode = slicer.mrmlScene.AddNewNodeByClass("vtkMRMLMarkupsFiducialNode", 'F')
     markups_widget = slicer.modules.markups.createNewWidgetRepresentation()
@@ -597,6 +641,243 @@ class INHSToolsLogic(ScriptedLoadableModuleLogic):
       # Since no files have a status, write to file without reloading
       slicer.util.saveNode(table, tableFilePath)
      
+  def createOutlierTable(self, results, tableName='LandmarkOutliers'):
+    # one row per specimen, flagged specimens first
+    table = slicer.mrmlScene.AddNewNodeByClass('vtkMRMLTableNode', tableName)
+    stringColumns = ['Specimen', 'Group', 'Reason']
+    numberColumns = ['LandmarkCount', 'ProcrustesDistance', 'DistanceScore', 'WorstLandmark', 'LandmarkScore']
+    columns = {}
+    for name in stringColumns:
+      columns[name] = vtk.vtkStringArray()
+    for name in numberColumns:
+      columns[name] = vtk.vtkDoubleArray()
+    for name in ['Specimen', 'Group', 'LandmarkCount', 'ProcrustesDistance', 'DistanceScore', 'WorstLandmark', 'LandmarkScore', 'Reason']:
+      columns[name].SetName(name)
+      table.AddColumn(columns[name])
+    for result in sorted(results, key=lambda r: (not r['flagged'], r['group'], r['specimen'])):
+      for name in stringColumns:
+        columns[name].InsertNextValue(result[name[0].lower() + name[1:]])
+      for name in numberColumns:
+        columns[name].InsertNextValue(result[name[0].lower() + name[1:]])
+    table.GetTable().Modified() # update table view
+    return table
+
+#
+# ProcrustesOutlierAnalysis
+#
+class ProcrustesOutlierAnalysis:
+  """Screens exported landmark files (.fcsv) for misplaced or misordered landmarks.
+  Specimens are grouped by a metadata column (Family or Genus), each group is aligned
+  with a generalized Procrustes analysis, and specimens whose Procrustes distance or
+  per-landmark residual is an outlier within the group are flagged.
+  The Procrustes distance is scored in groups of at least minGroupSize specimens. The
+  per-landmark test takes the worst of many landmark scores, and a median/MAD estimate is
+  unstable for a handful of specimens. So landmark residuals only flag specimens in groups
+  of at least minLandmarkGroupSize. In smaller groups the worst landmark and its score are
+  reported as information only.
+  The analysis keeps its state between runs: only new or modified files are re-read,
+  unchanged groups reuse their previous results, and changed groups start the alignment
+  from their previous consensus shape.
+  """
+  def __init__(self, groupColumn='Family', threshold=3.5, minGroupSize=5, minLandmarkGroupSize=20, maxIterations=50, tolerance=1e-8):
+    self.groupColumn = groupColumn
+    self.threshold = threshold # modified z-score cutoff
+    self.minGroupSize = minGroupSize
+    self.minLandmarkGroupSize = minLandmarkGroupSize
+    self.maxIterations = maxIterations
+    self.tolerance = tolerance
+    self.rankTolerance = 1e-3 # smallest/largest singular value of a usable landmark set
+    self.landmarkCache = {} # file path -> (mtime, size, revision, specimen, landmarks)
+    self.revision = 0
+    self.consensusCache = {} # (group, landmark count, dimension) -> consensus shape
+    self.resultCache = {} # group -> (group signature, results)
+
+  def loadMetadata(self, metadataPath):
+    # map specimen name (image file name without extension) to its metadata row
+    metadata = {}
+    with open(metadataPath, newline='') as metadataFile:
+      for row in csv.DictReader(metadataFile):
+        fileName = row.get('fileName')
+        if fileName:
+          metadata[os.path.splitext(os.path.basename(fileName))[0]] = row
+    return metadata
+
+  def readLandmarks(self, fcsvPath):
+    try:
+      landmarks = np.loadtxt(fcsvPath, delimiter=',', comments='#', usecols=(1, 2, 3), ndmin=2)
+    except (ValueError, IndexError, OSError):
+      logging.debug('Could not read landmarks from ' + fcsvPath)
+      return None
+    return landmarks.reshape(-1, 3)
+
+  def updateLandmarks(self, landmarkDir):
+    """Scan landmarkDir for .fcsv files, re-reading only files that are new or have changed.
+    Returns a dictionary of specimen name -> (revision, landmark array), where the
+    revision changes whenever the file is re-read.
+    """
+    currentPaths = set()
+    for root, dirs, files in os.walk(landmarkDir):
+      for fileName in files:
+        if not fileName.lower().endswith('.fcsv'):
+          continue
+        path = os.path.join(root, fileName)
+        currentPaths.add(path)
+        try:
+          fileStat = os.stat(path)
+        except OSError:
+          continue
+        cached = self.landmarkCache.get(path)
+        if cached and cached[0] == fileStat.st_mtime and cached[1] == fileStat.st_size:
+          continue
+        specimen = os.path.splitext(fileName)[0]
+        self.revision += 1
+        self.landmarkCache[path] = (fileStat.st_mtime, fileStat.st_size, self.revision, specimen, self.readLandmarks(path))
+    for path in set(self.landmarkCache) - currentPaths:
+      del self.landmarkCache[path]
+    specimens = {}
+    for path in sorted(self.landmarkCache):
+      mtime, size, revision, specimen, landmarks = self.landmarkCache[path]
+      if landmarks is not None:
+        specimens[specimen] = (revision, landmarks)
+    return specimens
+
+  def alignShapes(self, shapes, consensus=None):
+    """Generalized Procrustes alignment of an (N, K, D) array of landmark sets.
+    All specimens are rotated at once with batched SVDs. If a consensus shape from an
+    earlier run is given it is used as the starting reference.
+    Returns the aligned shapes and the consensus shape.
+    """
+    shapes = shapes - shapes.mean(axis=1, keepdims=True)
+    shapes = shapes / np.sqrt((shapes ** 2).sum(axis=(1, 2)))[:, None, None]
+    if consensus is None:
+      consensus = shapes[0]
+    consensus = consensus - consensus.mean(axis=0)
+    consensus = consensus / np.sqrt((consensus ** 2).sum())
+    for iteration in range(self.maxIterations):
+      # optimal rotation of each specimen onto the consensus, excluding reflections
+      u, s, vt = np.linalg.svd(np.einsum('nki,kj->nij', shapes, consensus))
+      reflections = np.linalg.det(np.matmul(u, vt)) < 0
+      u[reflections, :, -1] *= -1
+      shapes = np.matmul(shapes, np.matmul(u, vt))
+      newConsensus = shapes.mean(axis=0)
+      newConsensus = newConsensus / np.sqrt((newConsensus ** 2).sum())
+      change = np.sqrt(((newConsensus - consensus) ** 2).sum())
+      consensus = newConsensus
+      if change < self.tolerance:
+        break
+    return shapes, consensus
+
+  def robustScore(self, values):
+    # modified z-score (Iglewicz and Hoaglin) along the first axis
+    median = np.median(values, axis=0)
+    mad = np.median(np.abs(values - median), axis=0)
+    return 0.6745 * (values - median) / np.maximum(mad, 1e-9)
+
+  def analyzeGroup(self, group, specimenNames, shapeList):
+    results = []
+    counts = np.array([len(shape) for shape in shapeList])
+    # most common landmark count, ties going to the larger count so a complete set is never
+    # judged against an incomplete or empty one
+    countFrequencies = np.bincount(counts)
+    expectedCount = len(countFrequencies) - 1 - countFrequencies[::-1].argmax()
+    candidates = []
+    for name, shape, count in zip(specimenNames, shapeList, counts):
+      result = {'specimen': name, 'group': group, 'landmarkCount': count, 'procrustesDistance': np.nan,
+        'distanceScore': np.nan, 'worstLandmark': np.nan, 'landmarkScore': np.nan, 'flagged': False, 'reason': ''}
+      if count != expectedCount:
+        result['flagged'] = True
+        result['reason'] = 'landmark count %d (expected %d)' % (count, expectedCount)
+      elif count < 3:
+        # too few landmarks to align even in 2D, e.g. an export with no fiducials
+        result['flagged'] = True
+        result['reason'] = 'degenerate landmark set'
+      else:
+        candidates.append(len(results))
+      results.append(result)
+    if not candidates:
+      return results
+
+    shapes = np.stack([shapeList[i] for i in candidates])
+    if np.all(shapes[:, :, 2] == shapes[0, 0, 2]):
+      shapes = shapes[:, :, :2] # 2D images are exported with a constant Z
+    # a landmark set must span every dimension it is aligned in, otherwise its rotation is
+    # undefined or unstable (e.g. collinear points in 2D)
+    singularValues = np.linalg.svd(shapes - shapes.mean(axis=1, keepdims=True), compute_uv=False)
+    usable = singularValues[:, -1] > self.rankTolerance * singularValues[:, 0]
+    for index in np.array(candidates)[~usable]:
+      results[index]['flagged'] = True
+      results[index]['reason'] = 'degenerate landmark set'
+    members = [index for index, isUsable in zip(candidates, usable) if isUsable]
+    shapes = shapes[usable]
+    if len(members) < 2:
+      for index in members:
+        results[index]['reason'] = 'group too small to score'
+      return results
+
+    consensusKey = (group, shapes.shape[1], shapes.shape[2])
+    aligned, consensus = self.alignShapes(shapes, self.consensusCache.get(consensusKey))
+    self.consensusCache[consensusKey] = consensus
+
+    landmarkResiduals = np.sqrt(((aligned - consensus) ** 2).sum(axis=2))
+    distances = np.sqrt((landmarkResiduals ** 2).sum(axis=1))
+    canFlag = len(members) >= self.minGroupSize
+    canFlagLandmarks = len(members) >= self.minLandmarkGroupSize
+    if canFlag:
+      distanceScores = self.robustScore(distances)
+      # residual lengths are right skewed, so they are scored on a log scale
+      landmarkScores = self.robustScore(np.log(np.maximum(landmarkResiduals, 1e-12)))
+      worstLandmarks = landmarkScores.argmax(axis=1)
+      worstScores = landmarkScores[np.arange(len(members)), worstLandmarks]
+    for row, index in enumerate(members):
+      result = results[index]
+      result['procrustesDistance'] = distances[row]
+      if not canFlag:
+        result['reason'] = 'group too small to score'
+        continue
+      result['distanceScore'] = distanceScores[row]
+      result['worstLandmark'] = worstLandmarks[row] + 1 # fiducials are numbered from 1
+      result['landmarkScore'] = worstScores[row]
+      reasons = []
+      if distanceScores[row] > self.threshold:
+        reasons.append('Procrustes distance')
+      if canFlagLandmarks and worstScores[row] > self.threshold:
+        reasons.append('landmark %d residual' % result['worstLandmark'])
+      result['flagged'] = bool(reasons)
+      result['reason'] = ', '.join(reasons)
+    return results
+
+  def run(self, landmarkDir, metadataPath):
+    """Flag outlier landmark sets in landmarkDir, grouping specimens by self.groupColumn
+    of the metadata table. Returns a list of per-specimen result dictionaries.
+    """
+    metadata = self.loadMetadata(metadataPath)
+    specimens = self.updateLandmarks(landmarkDir)
+    groups = {}
+    unmatched = 0
+    for name in specimens:
+      row = metadata.get(name)
+      if row is None or not row.get(self.groupColumn):
+        unmatched += 1
+        continue
+      groups.setdefault(row[self.groupColumn], []).append(name)
+    if unmatched:
+      logging.info('%d landmark files have no %s in the metadata table' % (unmatched, self.groupColumn))
+
+    results = []
+    for group in sorted(groups):
+      names = groups[group]
+      signature = tuple((name, specimens[name][0]) for name in names)
+      cached = self.resultCache.get(group)
+      if cached and cached[0] == signature:
+        results.extend(cached[1])
+        continue
+      groupResults = self.analyzeGroup(group, names, [specimens[name][1] for name in names])
+      self.resultCache[group] = (signature, groupResults)
+      results.extend(groupResults)
+    for group in set(self.resultCache) - set(groups):
+      del self.resultCache[group]
+    return results
+
 class INHSToolsTest(ScriptedLoadableModuleTest):
   """
   This is the test case for your scripted module.
@@ -613,6 +894,8 @@ class INHSToolsTest(ScriptedLoadableModuleTest):
     """Run as few or as many tests as needed here.
     """
     self.setUp()
+    self.test_ProcrustesOutlierAnalysis()
+    self.setUp()
     self.test_INHSTools1()
 
   def test_INHSTools1(self):
@@ -650,3 +933,115 @@ class INHSToolsTest(ScriptedLoadableModuleTest):
     logic = INHSToolsLogic()
     self.assertIsNotNone( logic.hasImageData(volumeNode) )
     self.delayDisplay('Test passed!')
+
+  def test_ProcrustesOutlierAnalysis(self):
+    """ Write synthetic landmark exports with planted errors to a temporary folder,
+    check that exactly the planted errors are flagged, and that later runs only
+    re-read changed files and re-analyze their groups.
+    """
+
+    self.delayDisplay("Starting the Procrustes outlier test")
+    testDir = os.path.join(slicer.app.temporaryPath, 'ProcrustesOutlierTest')
+    shutil.rmtree(testDir, ignore_errors=True)
+    landmarkDir = os.path.join(testDir, 'landmarks')
+    os.makedirs(landmarkDir)
+
+    def writeLandmarks(path, landmarks):
+      with open(path, 'w') as fcsvFile:
+        fcsvFile.write('# Markups fiducial file version = 4.11\n')
+        fcsvFile.write('# CoordinateSystem = LPS\n')
+        fcsvFile.write('# columns = id,x,y,z,ow,ox,oy,oz,vis,sel,lock,label,desc,associatedNodeID\n')
+        for index, (x, y) in enumerate(landmarks):
+          fcsvFile.write('vtkMRMLMarkupsFiducialNode_%d,%f,%f,0,0,0,0,1,1,1,0,F-%d,,\n' % (index, x, y, index+1))
+
+    #
+    # two families of clean specimens, with planted errors in the first
+    #
+    random = np.random.RandomState(0)
+    template = random.normal(size=(12, 2)) * 10
+    planted = {}
+    metadataRows = []
+    for family, count in (('Centrarchidae', 30), ('Ictaluridae', 25)):
+      familyTemplate = template + random.normal(size=template.shape)
+      for index in range(count):
+        name = 'INHS_FISH_%s_%d' % (family, index)
+        landmarks = familyTemplate + random.normal(scale=0.2, size=template.shape)
+        if family == 'Centrarchidae' and index == 0:
+          landmarks = landmarks[[0, 1, 2, 4, 3, 5, 6, 7, 8, 9, 10, 11]]
+          planted[name] = 'swapped'
+        elif family == 'Centrarchidae' and index == 1:
+          landmarks[6] += 3
+          planted[name] = 'displaced'
+        elif family == 'Centrarchidae' and index == 2:
+          landmarks = landmarks * [-1, 1]
+          planted[name] = 'mirrored'
+        elif family == 'Centrarchidae' and index == 3:
+          landmarks = landmarks[:-1]
+          planted[name] = 'count'
+        # random pose and size, which the alignment should remove
+        angle = random.uniform(0, 2*np.pi)
+        rotation = np.array([[np.cos(angle), -np.sin(angle)], [np.sin(angle), np.cos(angle)]])
+        landmarks = landmarks.dot(rotation) * random.uniform(1, 3) + random.uniform(-100, 100, size=2)
+        writeLandmarks(os.path.join(landmarkDir, name + '.fcsv'), landmarks)
+        metadataRows.append({'fileName': name + '.jpg', 'Genus': family[:-5], 'Family': family})
+
+    # a lone export saved without any fiducials
+    writeLandmarks(os.path.join(landmarkDir, 'INHS_FISH_Cyprinidae_0.fcsv'), [])
+    metadataRows.append({'fileName': 'INHS_FISH_Cyprinidae_0.jpg', 'Genus': 'Cyprin', 'Family': 'Cyprinidae'})
+    planted['INHS_FISH_Cyprinidae_0'] = 'empty'
+    # an empty export tied with one complete export
+    writeLandmarks(os.path.join(landmarkDir, 'INHS_FISH_Esocidae_0.fcsv'), [])
+    writeLandmarks(os.path.join(landmarkDir, 'INHS_FISH_Esocidae_1.fcsv'), template)
+    for name in ('INHS_FISH_Esocidae_0', 'INHS_FISH_Esocidae_1'):
+      metadataRows.append({'fileName': name + '.jpg', 'Genus': 'Esox', 'Family': 'Esocidae'})
+    planted['INHS_FISH_Esocidae_0'] = 'empty'
+
+    metadataPath = os.path.join(testDir, 'metadata.csv')
+    with open(metadataPath, 'w', newline='') as metadataFile:
+      writer = csv.DictWriter(metadataFile, fieldnames=['fileName', 'Genus', 'Family'])
+      writer.writeheader()
+      writer.writerows(metadataRows)
+
+    analysis = ProcrustesOutlierAnalysis('Family')
+    results = analysis.run(landmarkDir, metadataPath)
+    self.assertEqual(len(results), 58)
+    flagged = dict((result['specimen'], result['reason']) for result in results if result['flagged'])
+    self.assertEqual(set(flagged), set(planted))
+    self.assertTrue(flagged['INHS_FISH_Centrarchidae_1'].endswith('landmark 7 residual'))
+    self.assertTrue(flagged['INHS_FISH_Centrarchidae_3'].startswith('landmark count 11'))
+    self.assertEqual(flagged['INHS_FISH_Cyprinidae_0'], 'degenerate landmark set')
+    self.assertEqual(flagged['INHS_FISH_Esocidae_0'], 'landmark count 0 (expected 12)')
+    loneResult = [result for result in results if result['specimen'] == 'INHS_FISH_Esocidae_1'][0]
+    self.assertEqual(loneResult['reason'], 'group too small to score')
+    self.delayDisplay('Planted errors flagged')
+
+    #
+    # record file reads and group analyses on later runs
+    #
+    readPaths = []
+    analyzedGroups = []
+    readLandmarks = analysis.readLandmarks
+    analyzeGroup = analysis.analyzeGroup
+    def recordRead(fcsvPath):
+      readPaths.append(fcsvPath)
+      return readLandmarks(fcsvPath)
+    def recordAnalysis(group, specimenNames, shapeList):
+      analyzedGroups.append(group)
+      return analyzeGroup(group, specimenNames, shapeList)
+    analysis.readLandmarks = recordRead
+    analysis.analyzeGroup = recordAnalysis
+
+    cachedResults = analysis.run(landmarkDir, metadataPath)
+    self.assertEqual(readPaths, [])
+    self.assertEqual(analyzedGroups, [])
+    self.assertEqual(len(cachedResults), len(results))
+    for cachedResult, result in zip(cachedResults, results):
+      self.assertIs(cachedResult, result)
+
+    touchedPath = os.path.join(landmarkDir, 'INHS_FISH_Ictaluridae_0.fcsv')
+    fileStat = os.stat(touchedPath)
+    os.utime(touchedPath, (fileStat.st_atime, fileStat.st_mtime + 10))
+    analysis.run(landmarkDir, metadataPath)
+    self.assertEqual(readPaths, [touchedPath])
+    self.assertEqual(analyzedGroups, ['Ictaluridae'])
+    self.delayDisplay('Test passed!')